@@ -51,20 +51,50 @@ import os
 import re
 import sys
 import json
+import math
 import time
+import shutil
 import logging
-import datetime
+import threading
 import argparse
-import subprocess
-from functools import partial
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from urllib.parse import urlencode
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+try:
+    import requests_cache
+except ImportError:
+    requests_cache = None
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+# RFC 3339 date format accepted by the catalogue: YYYY-MM-DDTHH:MM:SSZ
+_RFC3339_RE = re.compile(r'[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}:[0-9]{2}Z')
 
 def validate_Rfc3339(date_text):
-    try:
-        datetime.datetime.strptime(date_text, '%Y-%m-%dT%H:%M:%SZ')
-        return date_text
-    except:
+    if not _RFC3339_RE.fullmatch(date_text):
         raise ValueError("Incorrect date format, should be YYYY-MM-DDTHH:MM:SSZ")
+    return date_text
+
+def positive_int(value):
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError("%s is not a positive integer" % value)
+    return number
+
+# Remote filename in the Content-Disposition header of product downloads
+_FILENAME_RE = re.compile(r'filename=(\S+)')
+
+# Remote length in the Content-Range header of a 206 or 416 response:
+# bytes <first>-<last>/N or bytes */N
+_CONTENT_RANGE_RE = re.compile(r'bytes (?:\*|[0-9]+-[0-9]+)/([0-9]+)')
 
 class HRSIRequest(object):
     '''
@@ -75,6 +105,9 @@ class HRSIRequest(object):
     # Request URL root
     URL_ROOT = 'https://cryo.land.copernicus.eu/resto/api/collections/HRSI/search.json'
 
+    # Access token URL
+    TOKEN_URL = 'https://cryo.land.copernicus.eu/auth/realms/cryo/protocol/openid-connect/token'
+
     # URL parameter: geometry - region of interest, defined as WKT string (POINT, POLYGON, etc.)
     # in WGS84 projection.
     URL_PARAM_GEOMETRY = 'geometry'
@@ -117,27 +150,71 @@ class HRSIRequest(object):
         'sortOrder': 'descending'
     }
 
-    def __init__(self, outputPath):
+    # Lifetime of cached catalogue responses, in seconds.
+    CACHE_EXPIRE_AFTER = 3600
+
+    # The access token is refreshed this many seconds before its expiration.
+    TOKEN_EXPIRY_MARGIN = 30
+
+    # Number of result pages requested in parallel.
+    PAGE_WINDOW = 8
+
+    # Max number of result pages requested at once from the 'totalResults' estimate.
+    MAX_PAGE_WINDOW = 32
+
+    def __init__(self, outputPath, concurrency=4):
         self.outputPath = os.path.abspath(outputPath)
         if not os.path.exists(self.outputPath):
-            logging.info("Creating directory " + self.outputPath)
+            logging.info("Creating directory %s", self.outputPath)
             os.makedirs(self.outputPath)
         else:
-            logging.warning("Existing directory " + self.outputPath)
+            logging.warning("Existing directory %s", self.outputPath)
         self.hrsi_http_request = None
         self.hrsi_credential = None
         self.result_file = None
+        # Number of products downloaded in parallel
+        self.concurrency = concurrency
+        # HTTP session, keeping connections alive across page requests.
+        # When requests-cache is available, catalogue responses are cached on
+        # disk; token and product download requests are never cached.
+        if requests_cache is not None:
+            self.session = requests_cache.CachedSession(
+                cache_name=os.path.join(self.outputPath, '.clms_cache'),
+                backend='sqlite',
+                expire_after=HRSIRequest.CACHE_EXPIRE_AFTER,
+                allowable_methods=('GET', 'HEAD'),
+                urls_expire_after={
+                    '*/search.json*': HRSIRequest.CACHE_EXPIRE_AFTER,
+                    '*': requests_cache.DO_NOT_CACHE})
+        else:
+            self.session = requests.Session()
+        # The pool keeps one connection per page or download thread.
+        self.session.mount('https://', HTTPAdapter(pool_connections=4,
+            pool_maxsize=max(concurrency, HRSIRequest.PAGE_WINDOW),
+            max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[502, 503, 504])))
+        # Cached access token and its expiration time
+        self._token = None
+        self._token_exp = 0
+        self._token_suffix = None
+        self._token_lock = threading.Lock()
+        # Locks on product filepaths being downloaded
+        self._path_locks = {}
+        self._path_locks_lock = threading.Lock()
+
+    def close(self):
+        '''Close the HTTP session, once all requests and downloads are done.'''
+        self.session.close()
 
     def set_hrsi_http_request(self, hrsi_http_request):
-        logging.info("The query %s will be used to request HR-S&I products."%(hrsi_http_request))
+        logging.info("The query %s will be used to request HR-S&I products.", hrsi_http_request)
         self.hrsi_http_request = hrsi_http_request
 
     def set_hrsi_credential(self, hrsi_credential):
-        logging.info("The file %s will be used as credential to enable download."%(hrsi_credential))
+        logging.info("The file %s will be used as credential to enable download.", hrsi_credential)
         self.hrsi_credential = hrsi_credential
 
     def set_result_file(self, result_file):
-        logging.info("The file %s will be used as list of products to download."%(result_file))
+        logging.info("The file %s will be used as list of products to download.", result_file)
         self.result_file = result_file
 
     def build_request(self,
@@ -167,7 +244,7 @@ class HRSIRequest(object):
         url_params = {}
         if productIdentifier:
             url_params[HRSIRequest.URL_PARAM_PRODUCT_IDENTIFIER] = (
-                '%25' + productIdentifier + '%25')
+                '%' + productIdentifier + '%')
         if productType:
             url_params[HRSIRequest.URL_PARAM_PRODUCT_TYPE] = productType
         if obsDateMin:
@@ -187,15 +264,15 @@ class HRSIRequest(object):
         if geometry:
             url_params[HRSIRequest.URL_PARAM_GEOMETRY] = geometry
         if textualSearch:
-            url_params[HRSIRequest.URL_PARAM_TEXTUAL_SEARCH] = textualSearch.replace(' ','+')
+            url_params[HRSIRequest.URL_PARAM_TEXTUAL_SEARCH] = textualSearch
 
         if(url_params):
             url_params.update(HRSIRequest.URL_STATIC_PARAMS)
-            logging.info("Query parameters: ")
-            logging.info(url_params)
-            self.set_hrsi_http_request(HRSIRequest.URL_ROOT + \
-                      '?' + \
-                      '&'.join(['%s=%s'%(key, value) for key, value in url_params.items()]))
+            logging.info("Query parameters: %s", url_params)
+            # values are URL-encoded (spaces as '+', '%' as '%25'), range and list
+            # delimiters are kept as is
+            self.set_hrsi_http_request('%s?%s'%(HRSIRequest.URL_ROOT,
+                      urlencode(url_params, safe='[],')))
         else:
             logging.error("No query parameters were provided, no query was generated")
             sys.exit(-2)
@@ -208,14 +285,14 @@ class HRSIRequest(object):
             logging.error("No hrsi_http_request was provided or configured")
             sys.exit(-2)
 
-        logging.info("Requesting : " + self.hrsi_http_request)
+        logging.info("Requesting : %s", self.hrsi_http_request)
 
         # Send page requests, until no results are returned.
-        # The results have a 'totalResults' value that we could use, but
-        # it gives wrong and inconsistent values.
+        # The results have a 'totalResults' value that gives wrong and
+        # inconsistent values, it is only used to estimate the number of pages.
 
-        # Resulting hrsi_products
-        hrsi_products = []
+        # Resulting hrsi_products, only unique values are kept
+        hrsi_products = set()
 
         # Number of requested pages
         requested_pages = 0
@@ -224,56 +301,106 @@ class HRSIRequest(object):
         # and we have requested enough pages
         def first_exit_condition():
             return (max_requested_pages is not None) and (requested_pages >= max_requested_pages)
-        while not first_exit_condition():
-            requested_pages += 1
-            hrsi_products_aux = self.request_page(self.hrsi_http_request, requested_pages)
-
-            # Second exit condition: no results are returned
-            if not hrsi_products_aux:
-                break
-
-            # Save results
-            hrsi_products += hrsi_products_aux
 
-        # Only keep unique values and check for duplicate products
-        total_count = len(hrsi_products)
-        logging.debug(total_count, hrsi_products)
-        hrsi_products = set(hrsi_products)
-        if len(hrsi_products) != total_count:
-            logging.warning('Duplicated HRSI products found.')
-
-        logging.info("Found " + str(len(hrsi_products)) + " HR-S&I products.")
-
-        # Save result file in the output folder
+        # Result file in the output folder, products are listed as pages arrive
+        # in a .part file, renamed once all pages are processed
         self.set_result_file(os.path.join(self.outputPath, "result_file.txt"))
-        logging.info("Listing results in " + self.result_file)
-        with open(self.result_file, 'w') as f:
-            f.writelines([";".join(res)+"\n" for res in hrsi_products])
+        logging.info("Listing results in %s", self.result_file)
+        part_result_file = self.result_file + '.part'
+
+        with open(part_result_file, 'w') as f, \
+                ThreadPoolExecutor(max_workers=HRSIRequest.PAGE_WINDOW) as executor:
+
+            # Save new results and check for duplicate products
+            def save_page(page, hrsi_products_aux):
+                duplicates = 0
+                for hrsi_product in hrsi_products_aux:
+                    if hrsi_product in hrsi_products:
+                        duplicates += 1
+                        continue
+                    hrsi_products.add(hrsi_product)
+                    f.write('%s;%s\n'%hrsi_product)
+                if duplicates:
+                    logging.warning('Duplicated HRSI products found on page %d.', page)
+
+            # The first page is requested alone, its 'totalResults' sets the size
+            # of the first window of pages, with a safety margin of 2 pages.
+            last_page_reached = False
+            window = HRSIRequest.PAGE_WINDOW
+            if not first_exit_condition():
+                requested_pages += 1
+                hrsi_products_aux, total_results = self.request_page(self.hrsi_http_request, 1)
+                if not hrsi_products_aux:
+                    last_page_reached = True
+                else:
+                    save_page(1, hrsi_products_aux)
+                    if total_results:
+                        estimated_pages = int(math.ceil(float(total_results) / len(hrsi_products_aux))) + 2
+                        window = min(estimated_pages - requested_pages, HRSIRequest.MAX_PAGE_WINDOW)
+
+            # Next pages are requested by windows sent in parallel, then
+            # processed in order.
+            while not (first_exit_condition() or last_page_reached):
+                if max_requested_pages is not None:
+                    window = min(window, max_requested_pages - requested_pages)
+                pages = range(requested_pages + 1, requested_pages + 1 + window)
+                futures = [executor.submit(self.request_page, self.hrsi_http_request, page)
+                           for page in pages]
+                requested_pages += window
+                window = HRSIRequest.PAGE_WINDOW
+
+                try:
+                    for page, future in zip(pages, futures):
+                        hrsi_products_aux = future.result()[0]
+
+                        # Second exit condition: no results are returned,
+                        # following pages of the window are discarded
+                        if not hrsi_products_aux:
+                            last_page_reached = True
+                            break
+
+                        save_page(page, hrsi_products_aux)
+                finally:
+                    # cancel the discarded pages that are not requested yet
+                    for future in futures:
+                        future.cancel()
+
+        os.replace(part_result_file, self.result_file)
+        logging.info("Found %d HR-S&I products.", len(hrsi_products))
         return
 
     def request_page(self, http_request, page_index):
-        '''Request one page of HRSI products (each page contains URL_PAGE_SIZE products).'''
+        '''
+        Request one page of HRSI products (each page contains URL_PAGE_SIZE products).
+        :return: the page hrsi_products list, and the 'totalResults' value of the
+                 response (0 when missing).
+        '''
         current_page = http_request + '&page=' + str(page_index)
-        logging.info("Processing result page #%s"%(str(page_index)))
+        logging.info("Processing result page #%s", page_index)
 
         # Send Get request
-        response = requests.get(current_page)
+        response = self.session.get(current_page, timeout=(5, 30))
+
+        # A failing page aborts the query: only a page without features ends
+        # the listing
+        if not response:
+            logging.error('Result page #%s could not be requested:\n%s'\
+                '\nurl requested : \n%s',
+                page_index, response.text, current_page)
+        response.raise_for_status()
 
         # Read JSON response
-        json_root = {}
-        if response:
-            json_root = response.json()
+        json_root = _json_loads(response.content)
 
         # Get features
         try:
             features = json_root["features"]
         except KeyError:
-            features = {}
             logging.error('features entry is missing from the JSON response:\n%s'\
-                '\nurl parameters requested : \n%s' %(
+                '\nurl requested : \n%s',
                 json.dumps(json_root, indent=4),
-                json.dumps(url_params_page, indent=4)
-            ))
+                current_page)
+            raise
 
         # Resulting hrsi products
         hrsi_products = []
@@ -283,48 +410,40 @@ class HRSIRequest(object):
             hrsi_products.append(self.read_hrsi_feature(json_root, feature, feature_index))
 
         # Return the hrsi_products list
-        return hrsi_products
+        return hrsi_products, int(json_root.get('totalResults') or 0)
 
     def read_hrsi_feature(self, json_root, feature, feature_index):
-        '''Read a HRSI product JSON feature.'''
-
-        # Partial Python function. Then just add the json_param for each call.
-        read = partial(
-            self.read_json_param,
-            json_root, feature, feature_index)
-
-        # Full L1C path in the DIAS catalogue
-        hrsi_path = read('productIdentifier')
-        hrsi_title = read('title')
-        hrsi_obs_date = read('startDate')
-        hrsi_product_type = read('productType')
-        hrsi_url = read('services')['download']['url']
-        hrsi_size = read('services')['download']['size']
-        hrsi_publication_date = read('published')
-        return (hrsi_url, hrsi_title)
-
-    def read_json_param(self, json_root, feature, feature_index, json_param):
-        '''Read a JSON parameter.'''
+        '''Read a HRSI product JSON feature, as (download url, title).'''
         try:
-            return feature['properties'][json_param]
-        except KeyError:
+            properties = feature['properties']
+            return (properties['services']['download']['url'], properties['title'])
+        except KeyError as e:
             raise Exception(
-                'features[%d][\'properties\'][\'%s\'] entry is missing from the JSON contents:\n%s' %
-                (feature_index, json_param, json.dumps(json_root, indent=4)))
+                'features[%d] entry %s is missing from the JSON contents:\n%s' %
+                (feature_index, e, json.dumps(json_root, indent=4)))
 
     def __get_token__(self, credentials):
-        command = ['curl -s -d "client_id=PUBLIC"']
-        command.append('-d "username=%s"'%credentials[0])
-        command.append('-d "password=%s"'%credentials[1])
-        command.append('-d "grant_type=password"')
-        command.append('"https://cryo.land.copernicus.eu/auth/realms/cryo/protocol/openid-connect/token"')
-        out = eval(subprocess.check_output(" ".join(command), shell=True))
-        if 'error' in out:
-           logging.error("Following error occured when getting the token: {}".format(out))
-        return out['access_token']
-
-    def __hrsi_adress__(self, adress_id, credentials):
-        return '%s?token=%s'%(adress_id, self.__get_token__(credentials))
+        with self._token_lock:
+            # reuse the cached token until TOKEN_EXPIRY_MARGIN before its expiration
+            if self._token is not None and \
+                    time.time() < self._token_exp - HRSIRequest.TOKEN_EXPIRY_MARGIN:
+                return self._token
+            response = self.session.post(HRSIRequest.TOKEN_URL, data={
+                'client_id': 'PUBLIC',
+                'username': credentials[0],
+                'password': credentials[1],
+                'grant_type': 'password'}, timeout=10)
+            if not response:
+                logging.error("Following error occured when getting the token: %s", response.text)
+            response.raise_for_status()
+            out = response.json()
+            self._token = out['access_token']
+            # product URL suffix, shared by all downloads until the next refresh.
+            # It is set before the expiration time, which downloads read first
+            # without the lock: a valid expiration implies an up to date suffix.
+            self._token_suffix = '?token=' + self._token
+            self._token_exp = time.time() + out.get('expires_in', 0)
+            return self._token
 
     def download(self):
         # Check that the hrsi_credential was set before the call
@@ -339,7 +458,7 @@ class HRSIRequest(object):
             with open(self.hrsi_credential) as f:
                 credentials = f.readline().rstrip().split(':')
         except :
-            logging.error("Error while parsing credential file: " + str(self.hrsi_credential))
+            logging.error("Error while parsing credential file: %s", self.hrsi_credential)
             raise
             sys.exit(-2)
 
@@ -351,58 +470,157 @@ class HRSIRequest(object):
         #====================
         # read result_file
         #====================
+        # products are read line by line while downloading
+        def iter_products(f):
+            for x in f:
+                x = x.strip()
+                if x:
+                    yield x.split(';')
+
+        # request the token before starting downloads, it is then reused until expiration
+        self.__get_token__(credentials)
+
         try:
-            with open(self.result_file) as f:
-                content = f.readlines()
-            product_list = [x.strip().split(';') for x in content if x.strip()]
-            
+            result_file = open(self.result_file)
         except :
-            logging.error("Error while parsing result_file file: " + str(self.result_file))
+            logging.error("Error while parsing result_file file: %s", self.result_file)
             raise
             sys.exit(-2)
-        # loop to download all products within the list
-        for info_product in product_list:
-            start_time = time.time()
-            ntries = 0
-            max_retry = 1
-            while(ntries < max_retry):
+
+        # wait for the given downloads and count the failed ones
+        def check_downloads(done):
+            failed = 0
+            for future in done:
+                info_product = futures.pop(future)
                 try:
-                    # first info must be product url (mandatory)
-                    product_url = info_product[0]
-                    adress = self.__hrsi_adress__(product_url, credentials)
-
-                    # second info is product name (optional)
-                    dl_filename = None
-                    if len(info_product) >= 2:
-                        dl_filename = '%s.zip'%(info_product[1].split('/')[-1])
-
-                    # start actual download
-                    hrsi_filepath = self.download_with_curl(adress, dl_filename)
-                    logging.info('Product successfully downloaded at %s (in %s seconds)'\
-                                    %(hrsi_filepath, (time.time()-start_time)))
-                    break
-                except:
-                    ntries += 1
-                    if ntries == max_retry:
-                        raise
-                    else:
-                        time.sleep(5.*ntries)
-                        logging.info('  - try #%d failed, retrying...'%ntries)
+                    future.result()
+                except Exception as e:
+                    failed += 1
+                    logging.error('Download of %s failed: %s', info_product[0], e)
+            return failed
+
+        # download all products within the list, concurrency products at a time,
+        # with at most 2*concurrency products waiting in the pool
+        concurrency = self.concurrency
+        failed_products = 0
+        futures = {}
+        product_urls = set()
+        with result_file as f, ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for info_product in iter_products(f):
+                # the result file may list the same product url several times,
+                # the set of seen urls grows with the number of products
+                if info_product[0] in product_urls:
+                    logging.warning('Duplicated product %s skipped', info_product[0])
+                    continue
+                product_urls.add(info_product[0])
+                if len(futures) >= 2*concurrency:
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    failed_products += check_downloads(done)
+                futures[executor.submit(self._download_one, info_product, credentials)] = info_product
+            failed_products += check_downloads(as_completed(list(futures)))
+        if failed_products:
+            logging.error('%d product(s) could not be downloaded', failed_products)
+            sys.exit(-2)
+
+    def _download_one(self, info_product, credentials):
+        start_time = time.time()
+        ntries = 0
+        # retries resume from the partially downloaded file
+        max_retry = 3
+        while(ntries < max_retry):
+            try:
+                # first info must be product url (mandatory)
+                product_url = info_product[0]
+                # the cached token is only refreshed once it is about to expire,
+                # the expiration time must be read before the suffix
+                if time.time() >= self._token_exp - HRSIRequest.TOKEN_EXPIRY_MARGIN:
+                    self.__get_token__(credentials)
+                adress = product_url + self._token_suffix
+
+                # second info is product name (optional)
+                dl_filename = None
+                if len(info_product) >= 2:
+                    dl_filename = '%s.zip'%(info_product[1].split('/')[-1])
+
+                # start actual download
+                hrsi_filepath = self.download_with_curl(adress, dl_filename)
+                logging.info('Product successfully downloaded at %s (in %s seconds)',
+                                hrsi_filepath, time.time()-start_time)
+                return hrsi_filepath
+            except:
+                ntries += 1
+                if ntries == max_retry:
+                    raise
+                else:
+                    time.sleep(5.*ntries)
+                    logging.info('  - try #%d failed, retrying...', ntries)
 
     def download_with_curl(self, product_url, dl_filename=None):
         # parse header to read remote filename
         if dl_filename is None:
-            import re
-            headers = str(subprocess.check_output('curl -sI %s'%(product_url), shell=True))
-            dl_filename = re.findall("filename=(\S+)",str(headers))[0].split('\\r')[0]
+            response = self.session.head(product_url, allow_redirects=True, timeout=(5, 30))
+            response.raise_for_status()
+            headers = response.headers['Content-Disposition']
+            dl_filename = _FILENAME_RE.search(headers).group(1).strip('"')
             assert dl_filename.endswith('.zip')
         # download the product in outputPath
-        logging.info(dl_filename + " " + product_url.split("?token")[0])
+        logging.info("%s %s", dl_filename, product_url.split("?token")[0])
         hrsi_filepath = os.path.join(self.outputPath, dl_filename)
-        logging.debug('DL filepath: ' + hrsi_filepath)
-        subprocess.check_call('curl %s -o %s -s'%(product_url, hrsi_filepath), shell=True)
-        logging.debug('DL command: ' + 'curl %s -o %s -s'%(product_url, hrsi_filepath))
-        return hrsi_filepath
+        logging.debug('DL filepath: %s', hrsi_filepath)
+        # the same target path is never downloaded by two threads at once, the
+        # lock is kept with its number of users and dropped once unused
+        with self._path_locks_lock:
+            path_lock = self._path_locks.setdefault(hrsi_filepath, [threading.RLock(), 0])
+            path_lock[1] += 1
+        try:
+            with path_lock[0]:
+                # the product is first downloaded into a .part file, resumed from its
+                # current size if a previous try was interrupted
+                part_filepath = hrsi_filepath + '.part'
+                offset = os.path.getsize(part_filepath) if os.path.exists(part_filepath) else 0
+                headers = {'Range': 'bytes=%d-'%(offset)} if offset else None
+                expected_size = None
+                with self.session.get(product_url, headers=headers, stream=True, timeout=(5, 60)) as response:
+                    if offset and response.status_code == 416:
+                        content_range = _CONTENT_RANGE_RE.match(response.headers.get('Content-Range', ''))
+                        stale_part = content_range is None or int(content_range.group(1)) != offset
+                        if not stale_part:
+                            # the .part file already holds the whole product
+                            logging.debug('DL already complete: %s', part_filepath)
+                    else:
+                        stale_part = False
+                        response.raise_for_status()
+                        # server ignored the Range header: restart from the beginning
+                        mode = 'ab' if response.status_code == 206 else 'wb'
+                        if offset:
+                            logging.info('Resuming %s from byte %d', dl_filename, offset if mode == 'ab' else 0)
+                        # full product size, to detect truncated transfers
+                        if mode == 'ab':
+                            content_range = _CONTENT_RANGE_RE.match(response.headers.get('Content-Range', ''))
+                            if content_range is not None:
+                                expected_size = int(content_range.group(1))
+                        elif 'Content-Length' in response.headers and \
+                                'Content-Encoding' not in response.headers:
+                            expected_size = int(response.headers['Content-Length'])
+                        response.raw.decode_content = True
+                        with open(part_filepath, mode) as f:
+                            shutil.copyfileobj(response.raw, f, length=1<<20)
+                if stale_part:
+                    # the .part file does not match the remote product: restart from scratch
+                    logging.warning('Discarding partial download %s', part_filepath)
+                    os.remove(part_filepath)
+                    return self.download_with_curl(product_url, dl_filename)
+                if expected_size is not None and os.path.getsize(part_filepath) != expected_size:
+                    # keep the .part file, the next try resumes from it
+                    raise IOError('Truncated download of %s: %d bytes out of %d' %
+                                  (dl_filename, os.path.getsize(part_filepath), expected_size))
+                os.replace(part_filepath, hrsi_filepath)
+                return hrsi_filepath
+        finally:
+            with self._path_locks_lock:
+                path_lock[1] -= 1
+                if not path_lock[1]:
+                    del self._path_locks[hrsi_filepath]
 
 def main():
 
@@ -442,50 +660,55 @@ def main():
         help='text file containing valid login and password for HR-S&I portal (required for all downloading operations) in the following format: \"login:password\"')
     group_download.add_argument("-result_file", type=str, \
         help="to use the result file from previous query or containing multiple copied urls (required only for download mode)")
+    group_download.add_argument("-concurrency", type=positive_int, default=4, \
+        help="number of products downloaded in parallel (default: 4)")
 
     args = parser.parse_args()
 
     # Init Request
-    hrsi = HRSIRequest(args.output_dir)
+    hrsi = HRSIRequest(args.output_dir, args.concurrency)
     
-    # Switch to query mode
-    if args.query or args.query_and_download:
-        # First check if no query is provided as input.
-        if args.queryURL:
-            # Set the configured hrsi http request
-            hrsi.set_hrsi_http_request(args.queryURL)
-        # Build custom query, when hrsi_http_request is empty.
-        else:
-            hrsi_http_request = hrsi.build_request(
-                                args.productIdentifier,
-                                args.productType,
-                                args.obsDateMin,
-                                args.obsDateMax,
-                                args.publicationDateMin,
-                                args.publicationDateMax,
-                                args.cloudCoverageMax,
-                                args.geometry,
-                                args.textualSearch)
-
-        # Query HTTP API to list results
-        hrsi.execute_request()
-
-    # Switch to download from file mode (if enable)
-    if args.download:
-        if args.result_file:
-            hrsi.set_result_file(args.result_file)
+    # The HTTP session is closed whatever the outcome of the query and download
+    try:
+        # Switch to query mode
+        if args.query or args.query_and_download:
+            # First check if no query is provided as input.
+            if args.queryURL:
+                # Set the configured hrsi http request
+                hrsi.set_hrsi_http_request(args.queryURL)
+            # Build custom query, when hrsi_http_request is empty.
+            else:
+                hrsi_http_request = hrsi.build_request(
+                                    args.productIdentifier,
+                                    args.productType,
+                                    args.obsDateMin,
+                                    args.obsDateMax,
+                                    args.publicationDateMin,
+                                    args.publicationDateMax,
+                                    args.cloudCoverageMax,
+                                    args.geometry,
+                                    args.textualSearch)
+
+            # Query HTTP API to list results
+            hrsi.execute_request()
+
+        # Switch to download from file mode (if enable)
+        if args.download:
+            if args.result_file:
+                hrsi.set_result_file(args.result_file)
+            else:
+                logging.error("No HR-S&I result file was provided")
+
+        # Switch actual result download (if enable)
+        if args.query_and_download or args.download:
+            hrsi.set_hrsi_credential(args.hrsi_credentials)
+            logging.info("Start downloading...")
+            hrsi.download();
+            logging.info("Downloading complete!")
         else:
-            logging.error("No HR-S&I result file was provided")
-
-    # Switch actual result download (if enable)
-    if args.query_and_download or args.download:
-        hrsi.set_hrsi_credential(args.hrsi_credentials)
-        logging.info("Start downloading...")
-        hrsi.download();
-        logging.info("Downloading complete!")
-    else:
-        logging.info("No products were downloaded.")
-
+            logging.info("No products were downloaded.")
+    finally:
+        hrsi.close()
     logging.info("End.")
 
 